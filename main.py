@@ -4,17 +4,21 @@
 """
 Classifica e-mails em {Reclamação, Sugestão, Dúvida, Elogio}, gera resumo+resposta
 e decide ação de roteamento. Usa Google Gemini com prompts canônicos em PT-BR
-e robustez com retentativas (tenacity). Saída: um JSON por e-mail (stdout).
+e robustez com retentativas exponenciais. Saída: um JSON por e-mail (stdout).
 """
 
 import os
 import sys
 import json
 import re
+import asyncio
+import hashlib
+import itertools
 import logging
-from typing import Any, Dict, Optional
+import random
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, Optional
 
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from dotenv import load_dotenv
 
 try:
@@ -23,6 +27,12 @@ except Exception as e:
     print("Erro ao importar google-generativeai. Instale com: pip install -r requirements.txt", file=sys.stderr)
     raise
 
+# orjson (implementado em Rust) e opcional; cai para o json da stdlib se ausente
+try:
+    import orjson
+except Exception:
+    orjson = None
+
 # -----------------------
 # Configuração de logging
 # -----------------------
@@ -37,9 +47,18 @@ logger = logging.getLogger("gemini-email-router")
 # ------------------------------------
 ALLOWED_CATEGORIES = {"Reclamação", "Sugestão", "Dúvida", "Elogio"}
 
-PROMPT_CLASSIFICACAO = """Objetivo: receber texto de e-mail e retornar apenas JSON:
+# Regexes pre-compiladas do caminho quente de parse (evita recompilar a cada chamada)
+_FENCE_OPEN = re.compile(r"^```(?:json)?\s*", re.IGNORECASE)
+_FENCE_CLOSE = re.compile(r"\s*```$")
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+# Mapa para str.translate: aspas tipograficas -> aspas ASCII
+_SMART_QUOTES = {ord("“"): '"', ord("”"): '"', ord("‘"): "'", ord("’"): "'"}
+# Decoder incremental reutilizado para extrair JSON seguido de prosa
+_DECODER = json.JSONDecoder()
 
-{"categoria":"<Reclamação|Sugestão|Dúvida|Elogio>","justificativa":"<1 frase>"}
+SYSTEM_UNIFIED = """Objetivo: receber texto de e-mail e retornar apenas JSON:
+
+{"categoria":"<Reclamação|Sugestão|Dúvida|Elogio>","justificativa":"<1 frase>","resumo":"<1 frase>","resposta":"<resposta curta e educada em PT-BR>"}
 
 Instruções do prompt (inclua literalmente):
 
@@ -47,31 +66,35 @@ Tarefa: classifique o e-mail exatamente em UMA das categorias: Reclamação, Sug
 
 “Reclamação” = relato de problema/insatisfação; “Sugestão” = proposta de melhoria; “Dúvida” = pergunta/pedido de esclarecimento; “Elogio” = feedback positivo.
 
-Responda apenas com JSON válido no formato especificado; não inclua texto adicional.
-
 Se ambíguo entre duas categorias, escolha a mais consistente com a intenção principal.
 
-Se o texto estiver vazio ou ilegível, retorne: {"categoria":"Dúvida","justificativa":"Texto vazio ou incompreensível"}.
+Faça um resumo em 1 frase, fiel ao conteúdo (sem inventar).
+
+Gere uma resposta curta/educada, em PT-BR, neutra e objetiva; se houver nº de pedido mencionado, reconheça-o.
+
+Proíba promessas sem base (não inventar prazos/status).
+
+Responda apenas com JSON válido no formato especificado; não inclua texto adicional.
+
+Se o texto estiver vazio ou ilegível, retorne: {"categoria":"Dúvida","justificativa":"Texto vazio ou incompreensível","resumo":"Texto vazio; é necessário mais contexto do cliente.","resposta":"Poderia fornecer mais detalhes para ajudarmos com precisão?"}.
 
 Exemplos (few-shot):
 
 Input: “O produto chegou quebrado e o suporte não respondeu.”
-Output: {"categoria":"Reclamação","justificativa":"Relata defeito e falha no suporte"}
+Output: {"categoria":"Reclamação","justificativa":"Relata defeito e falha no suporte","resumo":"Cliente recebeu produto quebrado e não obteve resposta do suporte.","resposta":"Sentimos pelo transtorno. Encaminhamos seu relato ao suporte e retornaremos em breve com uma solução."}
 
 Input: “Seria ótimo ter filtro por tamanho nas buscas.”
-Output: {"categoria":"Sugestão","justificativa":"Propõe melhoria de usabilidade"}
+Output: {"categoria":"Sugestão","justificativa":"Propõe melhoria de usabilidade","resumo":"Cliente sugere filtro por tamanho na busca.","resposta":"Obrigado pela sugestão! Encaminhamos sua ideia ao time de produto para avaliação."}
 
 Input: “Qual é o prazo para troca de um item com defeito?”
-Output: {"categoria":"Dúvida","justificativa":"Pergunta sobre política de troca"}
+Output: {"categoria":"Dúvida","justificativa":"Pergunta sobre política de troca","resumo":"Cliente pergunta o prazo para troca de item com defeito.","resposta":"Obrigado pelo contato. Em breve enviaremos as informações sobre a política de troca de itens com defeito."}
 
 Input: “Equipe atenciosa e entrega rápida, parabéns!”
-Output: {"categoria":"Elogio","justificativa":"Expressa satisfação e reconhecimento"}
+Output: {"categoria":"Elogio","justificativa":"Expressa satisfação e reconhecimento","resumo":"Cliente elogia o atendimento e a rapidez da entrega.","resposta":"Agradecemos muito o seu elogio! Ficamos felizes em atender bem e vamos compartilhar com a equipe."}
 
-[ENTRADA]
-{{texto}}
 """
 
-PROMPT_SUM_RESPOSTA = """Objetivo: receber texto de e-mail e retornar apenas JSON:
+SYSTEM_RESUMO = """Objetivo: receber texto de e-mail e retornar apenas JSON:
 
 {"resumo":"<1 frase>","resposta":"<resposta curta e educada em PT-BR>"}
 
@@ -85,30 +108,154 @@ Proíba promessas sem base (não inventar prazos/status).
 
 Responda apenas com JSON válido no formato especificado.
 
-Se o texto estiver vazio, use resumo e resposta padrão solicitando mais detalhes.
-
 Exemplo:
 
 Input: “Pedido #12345 atrasado; paguei frete expresso; preciso até sábado.”
-Output:
+Output: {"resumo":"Cliente relata atraso do pedido #12345 com frete expresso e urgência.","resposta":"Sentimos pelo transtorno. Já solicitamos a verificação do pedido #12345 e retornaremos com o status atualizado. Caso precise de alternativa imediata, avise por favor."}
 
-{"resumo":"Cliente relata atraso do pedido #12345 com frete expresso e urgência.","resposta":"Sentimos pelo transtorno. Já solicitamos a verificação do pedido #12345 e retornaremos com o status atualizado. Caso precise de alternativa imediata, avise por favor."}
-
-[ENTRADA]
-{{texto}}
 """
 
-REPAIR_PROMPT = "Reescreva estritamente em JSON válido no formato exigido, sem explicações."
+# Limite de chamadas simultâneas ao Gemini (ajuste conforme a cota de RPM)
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+
+# Quantidade de registros acumulados antes de cada escrita em lote no stdout
+FLUSH_EVERY = 64
+
+# Janela de e-mails despachados concorrentemente por vez (memoria fica O(BATCH_SIZE))
+BATCH_SIZE = 32
+
+# Esquemas (estilo OpenAPI) para o modo de saída estruturada do Gemini; com
+# response_mime_type="application/json" o modelo é obrigado a emitir JSON
+# válido aderente ao esquema, eliminando a cauda "parse falhou -> reparo"
+SCHEMA_UNIFIED = {
+    "type": "object",
+    "properties": {
+        "categoria": {"type": "string", "enum": ["Reclamação", "Sugestão", "Dúvida", "Elogio"]},
+        "justificativa": {"type": "string"},
+        "resumo": {"type": "string"},
+        "resposta": {"type": "string"},
+    },
+    "required": ["categoria", "justificativa", "resumo", "resposta"],
+}
+SCHEMA_RESUMO = {
+    "type": "object",
+    "properties": {
+        "resumo": {"type": "string"},
+        "resposta": {"type": "string"},
+    },
+    "required": ["resumo", "resposta"],
+}
+
+# Configurações de geração construídas uma vez por prompt (o SDK não remonta
+# o dict a cada chamada). A latência do Gemini cresce com o teto de
+# max_output_tokens, então o orçamento é apertado ao tamanho real do JSON.
+GENCFG_UNIFIED = genai.types.GenerationConfig(
+    temperature=0.3,
+    top_p=0.5,
+    max_output_tokens=416,
+    response_mime_type="application/json",
+    response_schema=SCHEMA_UNIFIED,
+)
+GENCFG_RESUMO = genai.types.GenerationConfig(
+    temperature=0.4,
+    top_p=0.5,
+    max_output_tokens=320,
+    response_mime_type="application/json",
+    response_schema=SCHEMA_RESUMO,
+)
+# Variantes estritas para a retentativa apos falha de parse: temperatura zero +
+# esquema tornam a geracao deterministica e aderente ao JSON exigido
+GENCFG_UNIFIED_STRICT = genai.types.GenerationConfig(
+    temperature=0.0,
+    top_p=0.5,
+    max_output_tokens=416,
+    response_mime_type="application/json",
+    response_schema=SCHEMA_UNIFIED,
+)
+GENCFG_RESUMO_STRICT = genai.types.GenerationConfig(
+    temperature=0.0,
+    top_p=0.5,
+    max_output_tokens=320,
+    response_mime_type="application/json",
+    response_schema=SCHEMA_RESUMO,
+)
+
+# ---------------------------------------------------------
+# Classificação rápida por palavras-chave (sem ir ao modelo)
+# ---------------------------------------------------------
+# Lexicos curados por categoria; casam apenas sinais de superficie inequivocos
+_KEYWORD_PATTERNS = {
+    "Reclamação": re.compile(
+        r"quebrad|trincad|defeito|defeituos|não respond|nao respond|atras(?:o|ad)|"
+        r"insatisf|péssim|pessim|não funciona|nao funciona|reclama",
+        re.IGNORECASE,
+    ),
+    "Sugestão": re.compile(
+        r"seria ótimo|seria otimo|seria bom|poderiam adicionar|poderiam incluir|"
+        r"sugiro|sugestão|sugestao|que tal",
+        re.IGNORECASE,
+    ),
+    "Dúvida": re.compile(
+        r"como faço|como faco|como posso|qual é o prazo|qual e o prazo|qual o prazo|"
+        r"gostaria de saber|o que posso fazer|dúvida|duvida",
+        re.IGNORECASE,
+    ),
+    "Elogio": re.compile(
+        r"parabéns|parabens|obrigad[oa]|excelente|adorei|muito bom|atencios",
+        re.IGNORECASE,
+    ),
+}
+
+
+def _keyword_classify(text: str) -> Optional[str]:
+    """Classifica por léxico quando apenas UMA categoria casa; senão, None."""
+    # Coleta as categorias cujo lexico aparece no texto
+    matched = [cat for cat, pattern in _KEYWORD_PATTERNS.items() if pattern.search(text)]
+    # So confia no atalho quando o sinal e inequivoco (uma unica categoria)
+    if len(matched) == 1:
+        return matched[0]
+    return None
+
+# ------------------------------------------------
+# Cache de resultados por hash do corpo normalizado
+# ------------------------------------------------
+_WS = re.compile(r"\s+")
+CACHE_MAXSIZE = 4096
+# Cache LRU em memoria: chave = hash do corpo normalizado, valor = resultado da analise
+_CACHE: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+# Flag global; desativada com --no-cache na linha de comando
+CACHE_ENABLED = True
+
+
+def _cache_key(text: str) -> str:
+    """Gera chave estável a partir do corpo normalizado (espaços colapsados, minúsculas)."""
+    # Normaliza para que corpos quase identicos compartilhem a mesma entrada
+    norm = _WS.sub(" ", text.strip().lower())
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _cache_store(key: Optional[str], result: Dict[str, str]) -> None:
+    """Guarda o resultado no cache, descartando a entrada mais antiga se necessário."""
+    if key is None:
+        return
+    _CACHE[key] = result
+    # Mantem o cache dentro do limite configurado
+    if len(_CACHE) > CACHE_MAXSIZE:
+        _CACHE.popitem(last=False)
 
 # -----------------------
 # Cliente Gemini (global)
 # -----------------------
-MODEL: Optional[genai.GenerativeModel] = None
+# Um modelo por tarefa; as regras + few-shot viajam como system_instruction
+# (cacheadas do lado do servidor) em vez de reenviadas no corpo de cada chamada
+_MODELS: Dict[str, genai.GenerativeModel] = {}
 
 
-def init_gemini() -> genai.GenerativeModel:
-    """Configura o cliente Gemini a partir de variáveis de ambiente."""
-    global MODEL
+def init_gemini() -> None:
+    """Configura o cliente Gemini a partir de variáveis de ambiente (idempotente)."""
+    # Ja configurado (ex.: processo filho via fork herdou o estado); nada a refazer
+    if _MODELS:
+        return
     # Carrega variaveis de ambiente do arquivo .env, se existir
     load_dotenv()  # opcional; não falha se não existir .env
     # Le a chave da API e o nome do modelo definidos no ambiente
@@ -122,19 +269,18 @@ def init_gemini() -> genai.GenerativeModel:
 
     # Configura o SDK do Gemini com a chave informada
     genai.configure(api_key=api_key)
-    # Cria a instancia do modelo para reutilizacao global
-    MODEL = genai.GenerativeModel(model_name=model_name)
-    return MODEL
+    # Cria uma instancia por tarefa, fixando as instrucoes como system_instruction
+    _MODELS["unified"] = genai.GenerativeModel(model_name=model_name, system_instruction=SYSTEM_UNIFIED)
+    _MODELS["resumo"] = genai.GenerativeModel(model_name=model_name, system_instruction=SYSTEM_RESUMO)
 
 
-def get_model() -> genai.GenerativeModel:
-    """Obtém o modelo inicializado; se ainda não, inicializa agora."""
-    global MODEL
+def get_model(task: str) -> genai.GenerativeModel:
+    """Obtém o modelo da tarefa; se o cliente ainda não foi configurado, configura agora."""
     # Inicializa o cliente somente na primeira utilizacao
-    if MODEL is None:
-        return init_gemini()
-    # Reaproveita o modelo ja carregado nas chamadas seguintes
-    return MODEL
+    if not _MODELS:
+        init_gemini()
+    # Reaproveita a instancia ja carregada nas chamadas seguintes
+    return _MODELS[task]
 
 
 # ---------------------------------
@@ -144,56 +290,75 @@ class GeminiCallError(Exception):
     pass
 
 
-@retry(
-    reraise=True,
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=1, max=10),
-    retry=retry_if_exception_type(GeminiCallError),
-)
-def call_gemini(
-    prompt: str,
+# Numero maximo de tentativas por chamada ao modelo
+MAX_ATTEMPTS = 3
+
+
+def _extract_text(resp) -> str:
+    """Extrai o texto agregado de uma resposta do Gemini com ramos explícitos."""
+    # Sem candidatos nao ha texto; evita depender da property resp.text, que lanca
+    candidates = getattr(resp, "candidates", None)
+    if not candidates:
+        return ""
+    content = getattr(candidates[0], "content", None)
+    parts = getattr(content, "parts", None) if content is not None else None
+    if not parts:
+        return ""
+    # Junta apenas as partes que carregam texto
+    return "".join(getattr(p, "text", "") or "" for p in parts).strip()
+
+
+async def call_gemini(
+    task: str,
     input_text: str,
-    temperature: float = 0.2,
-    top_p: float = 0.95,
-    max_output_tokens: int = 512,
+    generation_config: genai.types.GenerationConfig = GENCFG_UNIFIED,
 ) -> str:
     """
-    Executa uma geração com Gemini usando um prompt e um texto de entrada.
-    Retorna o conteúdo de texto agregado. Levanta GeminiCallError para retentativas.
+    Executa uma geração com retentativas exponenciais (até 3 tentativas).
+    Retorna o conteúdo de texto agregado; relança GeminiCallError ao esgotar.
     """
-    # Garante que prompt e texto sejam strings validas antes da chamada
-    if not isinstance(prompt, str) or not isinstance(input_text, str):
-        raise GeminiCallError("prompt/input_text inválidos (tipos incorretos).")
+    last_error: Optional[GeminiCallError] = None
+    # Laco de retentativa enxuto, sem a maquina de estados do tenacity por chamada
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return await _call_gemini_once(task, input_text, generation_config)
+        except GeminiCallError as e:
+            last_error = e
+            # Espera exponencial com jitter leve antes da proxima tentativa
+            if attempt < MAX_ATTEMPTS - 1:
+                await asyncio.sleep(min(10, 1 << attempt) + random.random() * 0.1)
+    raise last_error
 
-    # Injeta o conteudo do e-mail no template do prompt
-    rendered = prompt.replace("{{texto}}", input_text)
+
+async def _call_gemini_once(
+    task: str,
+    input_text: str,
+    generation_config: genai.types.GenerationConfig = GENCFG_UNIFIED,
+) -> str:
+    """
+    Executa uma geração assíncrona com o modelo da tarefa; apenas o texto de
+    entrada viaja na requisição (as instruções ficam no system_instruction).
+    Retorna o conteúdo de texto agregado. Levanta GeminiCallError para retentativas.
+    """
+    # Garante que o texto de entrada seja valido antes da chamada
+    if not isinstance(input_text, str):
+        raise GeminiCallError("input_text inválido (tipo incorreto).")
 
     try:
-        # Recupera a instancia global do modelo configurado
-        model = get_model()
-        # Dispara a geracao de conteudo na API do Gemini
-        resp = model.generate_content(
-            rendered,
-            generation_config={
-                "temperature": temperature,
-                "top_p": top_p,
-                "max_output_tokens": max_output_tokens,
-            },
+        # Recupera a instancia do modelo da tarefa solicitada
+        model = get_model(task)
+        # Dispara a geracao de conteudo na API do Gemini sem bloquear o loop
+        resp = await model.generate_content_async(
+            input_text,
+            generation_config=generation_config,
         )
-        # Tenta obter o texto principal retornado pela API
-        text = getattr(resp, "text", None)
-        # Faz fallback para concatenar partes caso o campo principal esteja vazio
-        if not text:
-            try:
-                parts = resp.candidates[0].content.parts
-                text = "".join(getattr(p, "text", "") for p in parts)
-            except Exception:
-                text = None
+        # Normaliza a resposta em texto com ramos explicitos (sem except no caminho)
+        text = _extract_text(resp)
 
         # Solicita nova tentativa se a resposta permanecer vazia
-        if not text or not text.strip():
+        if not text:
             raise GeminiCallError("Resposta vazia do modelo.")
-        return text.strip()
+        return text
     except Exception as e:
         # Propaga erros como GeminiCallError para acionar retentativas
         raise GeminiCallError(str(e)) from e
@@ -212,12 +377,73 @@ def remove_code_fences(s: str) -> str:
     # Remove espacos extras nas extremidades
     s = s.strip()
     # Elimina cercas de codigo no inicio
-    s = re.sub(r"^```(?:json)?\s*", "", s, flags=re.IGNORECASE)
+    s = _FENCE_OPEN.sub("", s)
     # Elimina cercas de codigo no fim
-    s = re.sub(r"\s*```$", "", s)
+    s = _FENCE_CLOSE.sub("", s)
     return s.strip()
 
 
+def _loads(s: str) -> Any:
+    """Carrega JSON com orjson quando disponível; caso contrário, usa a stdlib."""
+    # Prefere o parser em C do orjson, ~2-4x mais rapido que o da stdlib
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
+def _dumps_line(record: Dict[str, Any]) -> bytes:
+    """Serializa o registro como uma linha JSON em UTF-8 (orjson quando disponível)."""
+    # orjson emite bytes UTF-8 direto e nao escapa nao-ASCII (como ensure_ascii=False)
+    if orjson is not None:
+        return orjson.dumps(record) + b"\n"
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _find_json_object(s: str) -> Optional[str]:
+    """Encontra o primeiro objeto `{...}` balanceado em uma varredura única."""
+    start = -1
+    depth = 0
+    in_string = False
+    escape = False
+    # Varre o texto uma unica vez controlando chaves, strings e escapes
+    for i, ch in enumerate(s):
+        if escape:
+            escape = False
+            continue
+        if ch == "\\" and in_string:
+            escape = True
+            continue
+        if ch == '"':
+            in_string = not in_string
+            continue
+        if in_string:
+            continue
+        if ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}" and depth > 0:
+            depth -= 1
+            # Fecha o objeto de nivel mais externo e devolve o trecho
+            if depth == 0:
+                return s[start : i + 1]
+    return None
+
+
+def _salvage(txt: str) -> Optional[Dict[str, Any]]:
+    """Última tentativa local: corrige aspas tipográficas e vírgulas finais."""
+    # Normaliza aspas tipograficas que invalidam o JSON
+    fixed = txt.translate(_SMART_QUOTES)
+    # Remove virgulas penduradas antes de } ou ]
+    fixed = _TRAILING_COMMA.sub(r"\1", fixed)
+    # Revarre o texto corrigido em busca de um objeto balanceado
+    candidate = _find_json_object(fixed) or fixed
+    try:
+        return _loads(candidate)
+    except Exception:
+        return None
+
+
 def parse_json_maybe(s: str) -> Optional[Dict[str, Any]]:
     """Tenta carregar JSON com algumas tolerâncias leves."""
     # Nao tenta parsear quando nao ha conteudo
@@ -227,17 +453,33 @@ def parse_json_maybe(s: str) -> Optional[Dict[str, Any]]:
     txt = remove_code_fences(s)
     # Tenta carregar o JSON diretamente da resposta
     try:
-        return json.loads(txt)
+        return _loads(txt)
     except Exception:
-        # Busca manualmente um objeto JSON delimitado dentro do texto
-        m = re.search(r"\{[\s\S]*\}", txt)
-        if m:
-            try:
-                return json.loads(m.group(0))
-            except Exception:
-                return None
-    # Retorna None caso nenhum JSON valido seja encontrado
-    return None
+        pass
+    # Parser incremental: aceita JSON valido seguido de prosa, sem varredura extra
+    stripped = txt.lstrip()
+    try:
+        obj, _ = _DECODER.raw_decode(stripped)
+        return obj
+    except Exception:
+        pass
+    # Prosa antes do JSON: tenta decodificar a partir da primeira chave
+    start = stripped.find("{")
+    if start > 0:
+        try:
+            obj, _ = _DECODER.raw_decode(stripped, start)
+            return obj
+        except Exception:
+            pass
+    # Busca o primeiro objeto balanceado dentro do texto (varredura O(n))
+    candidate = _find_json_object(txt)
+    if candidate:
+        try:
+            return _loads(candidate)
+        except Exception:
+            pass
+    # Esgota as correcoes locais antes de o chamador pagar uma chamada de reparo
+    return _salvage(txt)
 
 
 # -----------------------
@@ -253,200 +495,283 @@ def validate_category(categoria: str) -> str:
     return "Dúvida"
 
 
-def classify_email(text: str) -> Dict[str, str]:
-    """Classifica um e-mail com justificativa curta. Sempre retorna JSON válido."""
+async def analyze_email(text: str) -> Dict[str, str]:
+    """Classifica, resume e responde um e-mail em uma única chamada. Sempre retorna JSON válido."""
     # Retorna fallback padrao quando o corpo do e-mail esta vazio
-    if not isinstance(text, str) or not text.strip():
-        return {"categoria": "Dúvida", "justificativa": "Texto vazio ou incompreensível"}
-
-    # Chama o modelo para classificar o texto recebido
-    raw = call_gemini(
-        prompt=PROMPT_CLASSIFICACAO,
-        input_text=text,
-        temperature=0.2,
-        top_p=0.3,
-        max_output_tokens=256,
-    )
-    # Tenta interpretar a resposta como JSON estruturado
-    data = parse_json_maybe(raw)
-
-    # Solicita ao modelo que reescreva a resposta caso o JSON venha invalido
-    if data is None:
-        # Solicita reparo de JSON ao modelo para tentar novo parse
-        repair_raw = call_gemini(
-            prompt=REPAIR_PROMPT,
-            input_text=raw,
-            temperature=0.2,
-            top_p=0.3,
-            max_output_tokens=256,
-        )
-        data = parse_json_maybe(repair_raw)
-
-    # Usa categoria de seguranca se o reparo tambem falhar
-    if not isinstance(data, dict):
-        return {"categoria": "Dúvida", "justificativa": "Falha ao interpretar resposta do modelo"}
-
-    # Normaliza a categoria e garante que esteja permitida
-    categoria = validate_category(data.get("categoria", "Dúvida"))
-    justificativa = data.get("justificativa", "") or "Classificação automática"
-    return {"categoria": categoria, "justificativa": justificativa}
-
-
-def summarize_and_reply(text: str) -> Dict[str, str]:
-    """Gera resumo (1 frase) e resposta curta/educada em PT-BR."""
-    # Retorna mensagens padrao quando nao ha conteudo para resumir
     if not isinstance(text, str) or not text.strip():
         return {
+            "categoria": "Dúvida",
+            "justificativa": "Texto vazio ou incompreensível",
             "resumo": "Texto vazio; é necessário mais contexto do cliente.",
             "resposta": "Poderia fornecer mais detalhes (ex.: número do pedido e descrição do ocorrido) para ajudarmos com precisão?",
         }
 
-    # Pede ao modelo resumo e resposta curta para o e-mail
-    raw = call_gemini(
-        prompt=PROMPT_SUM_RESPOSTA,
+    # Reaproveita resultado de corpo identico ja analisado (evita nova chamada de rede)
+    key = _cache_key(text) if CACHE_ENABLED else None
+    if key is not None and key in _CACHE:
+        _CACHE.move_to_end(key)
+        return dict(_CACHE[key])
+
+    # Atalho deterministico: se o lexico aponta uma unica categoria, dispensa a
+    # classificacao pelo modelo e pede apenas resumo/resposta (menos tokens)
+    fast_cat = _keyword_classify(text)
+    if fast_cat is not None:
+        raw = await call_gemini(
+            task="resumo",
+            input_text=text,
+            generation_config=GENCFG_RESUMO,
+        )
+        data = parse_json_maybe(raw)
+        # Reemite o mesmo prompt em modo estrito caso o primeiro parse falhe
+        if data is None:
+            retry_raw = await call_gemini(
+                task="resumo",
+                input_text=text,
+                generation_config=GENCFG_RESUMO_STRICT,
+            )
+            data = parse_json_maybe(retry_raw)
+        # Fallback degradado nao vai ao cache: uma falha transitoria de parse
+        # nao deve pinar o resumo generico para este corpo (como no caminho unificado)
+        if not isinstance(data, dict):
+            return {
+                "categoria": fast_cat,
+                "justificativa": "Regra por palavras-chave",
+                "resumo": "Conteúdo não pôde ser resumido com segurança.",
+                "resposta": "Agradecemos a mensagem. Pode compartilhar mais detalhes para apoiarmos melhor?",
+            }
+        result = {
+            "categoria": fast_cat,
+            "justificativa": "Regra por palavras-chave",
+            "resumo": data.get("resumo", "") or "Resumo indisponível.",
+            "resposta": data.get("resposta", "") or "Agradecemos a mensagem. Em breve retornaremos com mais informações.",
+        }
+        _cache_store(key, result)
+        return dict(result)
+
+    # Chama o modelo uma unica vez para classificar, resumir e responder
+    raw = await call_gemini(
+        task="unified",
         input_text=text,
-        temperature=0.4,
-        top_p=0.5,
-        max_output_tokens=512,
+        generation_config=GENCFG_UNIFIED,
     )
-    # Procura extrair JSON estruturado com resumo e resposta
+    # Tenta interpretar a resposta como JSON estruturado
     data = parse_json_maybe(raw)
 
-    # Tenta reparar a saida caso o primeiro parse falhe
+    # Reemite o mesmo prompt em modo estrito caso o JSON venha invalido
     if data is None:
-        # Solicita reparo de JSON ao modelo para tentar novo parse
-        repair_raw = call_gemini(
-            prompt=REPAIR_PROMPT,
-            input_text=raw,
-            temperature=0.4,
-            top_p=0.5,
-            max_output_tokens=512,
+        # Temperatura zero + esquema rendem JSON valido de forma deterministica
+        retry_raw = await call_gemini(
+            task="unified",
+            input_text=text,
+            generation_config=GENCFG_UNIFIED_STRICT,
         )
-        data = parse_json_maybe(repair_raw)
+        data = parse_json_maybe(retry_raw)
 
-    # Aplica fallback seguro quando nao e possivel confiar nos dados
+    # Aplica fallback seguro se a retentativa estrita tambem falhar
     if not isinstance(data, dict):
         return {
+            "categoria": "Dúvida",
+            "justificativa": "Falha ao interpretar resposta do modelo",
             "resumo": "Conteúdo não pôde ser resumido com segurança.",
             "resposta": "Agradecemos a mensagem. Pode compartilhar mais detalhes para apoiarmos melhor?",
         }
 
+    # Normaliza a categoria e garante que esteja permitida
+    categoria = validate_category(data.get("categoria", "Dúvida"))
+    justificativa = data.get("justificativa", "") or "Classificação automática"
     # Garante texto padrao caso o resumo venha vazio
     resumo = data.get("resumo", "") or "Resumo indisponível."
     # Define resposta padrao quando o modelo nao retornar conteudo
     resposta = data.get("resposta", "") or "Agradecemos a mensagem. Em breve retornaremos com mais informações."
-    return {"resumo": resumo, "resposta": resposta}
+    result = {
+        "categoria": categoria,
+        "justificativa": justificativa,
+        "resumo": resumo,
+        "resposta": resposta,
+    }
+    _cache_store(key, result)
+    return dict(result)
+
+
+# Mapeamento categoria -> acao, orientado a dados (novas categorias entram aqui)
+_ROUTE_TABLE: Dict[str, Dict[str, str]] = {
+    # Direciona reclamacoes para canal critico no Slack
+    "Reclamação": {"acao": "abrir_notificacao_slack", "destino": "#reclamacoes-urgentes"},
+    # Encaminha sugestoes para o time de produto
+    "Sugestão": {"acao": "encaminhar_time_produto", "fila": "ideias"},
+    # Para duvidas, orienta resposta ao cliente
+    "Dúvida": {"acao": "responder_cliente", "template": "faq_basico"},
+    # Elogios sao etiquetados
+    "Elogio": {"acao": "marcar_como_elogio", "etiqueta": "elogios"},
+}
 
 
 def route_action(category: str) -> Dict[str, str]:
     """Decide a ação com base na categoria."""
-    # Reforca que a categoria usada na decisao e valida
-    category = validate_category(category)
-    # Direciona reclamacoes para canal critico no Slack
-    if category == "Reclamação":
-        return {"acao": "abrir_notificacao_slack", "destino": "#reclamacoes-urgentes"}
-    # Encaminha sugestoes para o time de produto
-    if category == "Sugestão":
-        return {"acao": "encaminhar_time_produto", "fila": "ideias"}
-    # Para duvidas, orienta resposta ao cliente
-    if category == "Dúvida":
-        return {"acao": "responder_cliente", "template": "faq_basico"}
-    # Demais casos viram elogios etiquetados
-    return {"acao": "marcar_como_elogio", "etiqueta": "elogios"}
+    # validate_category garante que a chave exista na tabela
+    return _ROUTE_TABLE[validate_category(category)]
 
 
 # -----------------------
 # Execução principal
 # -----------------------
+async def process(email: Dict[str, str], sem: asyncio.Semaphore) -> Optional[Dict[str, Any]]:
+    """Processa um e-mail com uma chamada unificada ao modelo; retorna o registro final."""
+    try:
+        # Extrai pequeno trecho do corpo para logging
+        snippet = email.get("corpo", "") or ""
+        # Registra no log qual e-mail esta em processamento
+        logger.info(
+            f"Processando id={email.get('id')} assunto='{email.get('assunto', '')}' corpo='{snippet}'"
+        )
+
+        # Limita o numero de e-mails simultaneos na API
+        async with sem:
+            # Uma unica chamada resolve classificacao, resumo e resposta
+            result = await analyze_email(email.get("corpo", ""))
+        # Extrai a categoria retornada com fallback seguro
+        cat = result.get("categoria", "Dúvida")
+        # Determina a acao de roteamento com base na categoria
+        act = route_action(cat)
+
+        # Agrupa os dados para gerar a saida final
+        return {
+            "id": email.get("id"),
+            "categoria": cat,
+            "resumo": result.get("resumo", ""),
+            "resposta": result.get("resposta", ""),
+            "acao": act,
+        }
+    # Evita que uma excecao interrompa o processamento dos demais e-mails
+    except Exception as e:
+        # Registra detalhes do erro encontrado
+        logger.error(f"Falha ao processar id={email.get('id')}: {e}")
+        return None
+
+
+async def run_all(emails: Iterable[Dict[str, Any]]) -> None:
+    """Processa e-mails em janelas concorrentes de BATCH_SIZE e imprime os resultados."""
+    # Aquece o canal gRPC assincrono (o mesmo das geracoes) antes do fanout,
+    # para que a primeira leva de chamadas nao dispute o estabelecimento da conexao
+    try:
+        await get_model("unified").count_tokens_async("warmup")
+    except Exception as e:
+        # Aquecimento e melhor esforco; falha aqui nao impede o fluxo principal
+        logger.warning(f"Falha no warmup do cliente Gemini (seguindo mesmo assim): {e}")
+
+    # Semaforo compartilhado para respeitar a cota de requisicoes por minuto
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    it = iter(emails)
+    # Acumula linhas e escreve em lote, evitando um write/flush por e-mail
+    batch = []
+    try:
+        while True:
+            # Puxa a proxima janela do fluxo; nao materializa a entrada inteira
+            window = list(itertools.islice(it, BATCH_SIZE))
+            if not window:
+                break
+            # Sobrepoe as esperas de rede da janela em vez de serializa-las
+            records = await asyncio.gather(*(process(email, sem) for email in window))
+            for record in records:
+                if record is not None:
+                    batch.append(_dumps_line(record))
+                    if len(batch) >= FLUSH_EVERY:
+                        sys.stdout.buffer.writelines(batch)
+                        batch.clear()
+    finally:
+        # Descarrega o que ja foi processado mesmo em caso de erro ou interrupcao
+        if batch:
+            sys.stdout.buffer.writelines(batch)
+        sys.stdout.buffer.flush()
+
+
+# Fixture inline usada quando nao ha NDJSON no stdin (execucao interativa)
+SAMPLE_EMAILS = [
+    {
+        "id": "eml-001",
+        "remetente": "cliente1@example.com",
+        "assunto": "Produto com problema e sem resposta",
+        "corpo": "O produto chegou com a tela trincada e ninguém responde meu ticket.",
+    },
+    {
+        "id": "eml-002",
+        "remetente": "cliente2@example.com",
+        "assunto": "Filtro por cor",
+        "corpo": "Poderiam adicionar filtro por cor na busca?",
+    },
+    {
+        "id": "eml-003",
+        "remetente": "cliente3@example.com",
+        "assunto": "Troca em 30 dias",
+        "corpo": "Como faço para trocar um item defeituoso dentro de 30 dias?",
+    },
+    {
+        "id": "eml-004",
+        "remetente": "cliente4@example.com",
+        "assunto": "Agradecimento",
+        "corpo": "Atendimento excelente, entrega no prazo. Obrigado!",
+    },
+    {
+        "id": "eml-005",
+        "remetente": "cliente5@example.com",
+        "assunto": "Pedido atrasado",
+        "corpo": "Meu pedido #98765 está atrasado e viajo amanhã, o que posso fazer?",
+    },
+    {
+        "id": "eml-006",
+        "remetente": "cliente6@example.com",
+        "assunto": "Sem conteúdo",
+        "corpo": "",
+    },
+    {
+        "id": "eml-007",
+        "remetente": "cliente7@example.com",
+        "assunto": "Texto ruidoso",
+        "corpo": "asdf 123!!! ?? ajuda, talvez, não sei, pedido 00000?",
+    },
+    {
+        "id": "eml-008",
+        "remetente": "cliente8@example.com",
+        "assunto": "Elogio + sugestão",
+        "corpo": "Equipe muito boa! Talvez um modo escuro no app ajudaria à noite.",
+    },
+]
+
+
+def iter_emails() -> Iterator[Dict[str, Any]]:
+    """Itera e-mails em NDJSON do stdin; em terminal interativo, usa a fixture inline."""
+    # Sem pipe na entrada, processa os e-mails simulados
+    if sys.stdin.isatty():
+        yield from SAMPLE_EMAILS
+        return
+    # Uma linha por e-mail; linhas vazias ou invalidas nao derrubam o fluxo
+    for line in sys.stdin.buffer:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            obj = _loads(line)
+        except Exception as e:
+            logger.error(f"Linha NDJSON inválida ignorada: {e}")
+            continue
+        # JSON valido mas que nao e um objeto (lista, numero, string) tambem e descartado
+        if not isinstance(obj, dict):
+            logger.error(f"Linha NDJSON ignorada: esperado objeto, veio {type(obj).__name__}")
+            continue
+        yield obj
+
+
 def main() -> None:
+    global CACHE_ENABLED
+    # Permite desligar o cache em avaliacoes (cada e-mail sempre vai ao modelo)
+    if "--no-cache" in sys.argv[1:]:
+        CACHE_ENABLED = False
+
     # Inicializa o cliente do Gemini antes de processar
     init_gemini()
 
-    # Define a lista de e-mails de exemplo a serem processados
-    emails = [
-        {
-            "id": "eml-001",
-            "remetente": "cliente1@example.com",
-            "assunto": "Produto com problema e sem resposta",
-            "corpo": "O produto chegou com a tela trincada e ninguém responde meu ticket.",
-        },
-        {
-            "id": "eml-002",
-            "remetente": "cliente2@example.com",
-            "assunto": "Filtro por cor",
-            "corpo": "Poderiam adicionar filtro por cor na busca?",
-        },
-        {
-            "id": "eml-003",
-            "remetente": "cliente3@example.com",
-            "assunto": "Troca em 30 dias",
-            "corpo": "Como faço para trocar um item defeituoso dentro de 30 dias?",
-        },
-        {
-            "id": "eml-004",
-            "remetente": "cliente4@example.com",
-            "assunto": "Agradecimento",
-            "corpo": "Atendimento excelente, entrega no prazo. Obrigado!",
-        },
-        {
-            "id": "eml-005",
-            "remetente": "cliente5@example.com",
-            "assunto": "Pedido atrasado",
-            "corpo": "Meu pedido #98765 está atrasado e viajo amanhã, o que posso fazer?",
-        },
-        {
-            "id": "eml-006",
-            "remetente": "cliente6@example.com",
-            "assunto": "Sem conteúdo",
-            "corpo": "",
-        },
-        {
-            "id": "eml-007",
-            "remetente": "cliente7@example.com",
-            "assunto": "Texto ruidoso",
-            "corpo": "asdf 123!!! ?? ajuda, talvez, não sei, pedido 00000?",
-        },
-        {
-            "id": "eml-008",
-            "remetente": "cliente8@example.com",
-            "assunto": "Elogio + sugestão",
-            "corpo": "Equipe muito boa! Talvez um modo escuro no app ajudaria à noite.",
-        },
-    ]
-
-    # Itera pelos e-mails simulados para aplicar o fluxo
-    for email in emails:
-        try:
-            # Extrai pequeno trecho do corpo para logging
-            snippet = email.get("corpo", "") or ""
-            # Registra no log qual e-mail esta em processamento
-            logger.info(
-                f"Processando id={email.get('id')} assunto='{email.get('assunto', '')}' corpo='{snippet}'"
-            )
-
-            # Obtem a classificacao automatica do e-mail
-            cls = classify_email(email.get("corpo", ""))
-            # Extrai a categoria retornada com fallback seguro
-            cat = cls.get("categoria", "Dúvida")
-            # Determina a acao de roteamento com base na categoria
-            act = route_action(cat)
-            # Solicita resumo e resposta automatica ao modelo
-            sr = summarize_and_reply(email.get("corpo", ""))
-
-            # Agrupa os dados para gerar a saida final
-            record = {
-                "id": email.get("id"),
-                "categoria": cat,
-                "resumo": sr.get("resumo", ""),
-                "resposta": sr.get("resposta", ""),
-                "acao": act,
-            }
-            # Emite o resultado no formato JSON no stdout
-            print(json.dumps(record, ensure_ascii=False))
-        # Evita que uma excecao interrompa o processamento dos demais e-mails
-        except Exception as e:
-            # Registra detalhes do erro encontrado
-            logger.error(f"Falha ao processar id={email.get('id')}: {e}")
+    # Processa o fluxo de e-mails de forma concorrente no loop de eventos
+    asyncio.run(run_all(iter_emails()))
 
 
 if __name__ == "__main__":